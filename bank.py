@@ -0,0 +1,162 @@
+import torch
+from layer import *
+import os
+import time
+
+
+class Conceptor_Bank(Layer):
+    # many linear conceptors over the same input space, the bases are stacked into one [num_conceptors, dim, rank] tensor.
+    # a conceptor with fewer bases than the widest one is padded with zero columns, which encode to zero and reconstruct nothing.
+
+    def __init__(self, device, num_conceptors, dim, file_path=None):
+        print("init")
+        self.device = device
+        self.dim = dim
+        self.weights = torch.zeros(num_conceptors, dim, 0, device=device)
+        self.importances = torch.zeros(num_conceptors, 0, device=device)
+        self.ranks = torch.zeros(num_conceptors, dtype=torch.int64, device=device)
+        self.file_path = file_path
+
+    def save(self):
+        if self.file_path:
+            torch.save({"weights": self.weights, "importances": self.importances, "ranks": self.ranks}, self.file_path)
+
+    def load(self):
+        if self.file_path:
+            temp = torch.load(self.file_path)
+            self.weights = temp["weights"]
+            self.importances = temp["importances"]
+            self.ranks = temp["ranks"]
+
+    def __internal__fit(self, input):
+        if input.shape[-1] > self.dim:
+            raise ValueError("input is wider than the bank dim.")
+        return torch.nn.functional.pad(input, (0, self.dim - input.shape[-1]))
+
+    def __internal__group(self, input, labels):
+        # [batch, dim] with a conceptor index per row into [num_conceptors, max rows, dim], zero rows add nothing to a Gram matrix.
+        counts = torch.bincount(labels, minlength=self.weights.shape[0])
+        order = torch.argsort(labels, stable=True)
+        sorted_labels = labels[order]
+        offsets = torch.cumsum(counts, dim=0) - counts
+        positions = torch.arange(labels.shape[0], device=labels.device) - offsets[sorted_labels]
+
+        res = torch.zeros(self.weights.shape[0], max(torch.max(counts).item(), 1), self.dim, device=self.device)
+        res[sorted_labels, positions] = input[order]
+        return res, counts
+
+    def __internal__append(self, indices, A, M):
+        expand_depth = A.shape[2]
+        width = torch.max(self.ranks[indices]).item() + expand_depth
+        if width > self.weights.shape[2]:
+            grow = width - self.weights.shape[2]
+            self.weights = torch.nn.functional.pad(self.weights, (0, grow))
+            self.importances = torch.nn.functional.pad(self.importances, (0, grow))
+
+        columns = torch.unsqueeze(self.ranks[indices], 1) + torch.arange(expand_depth, device=self.device)
+        rows = torch.unsqueeze(indices, 1)
+        self.weights[rows, :, columns] = torch.transpose(A, 1, 2)
+        self.importances[rows, columns] = M
+        self.ranks[indices] = self.ranks[indices] + expand_depth
+
+    def learn(self, input, labels=None, expand_depth=1, expand_threshold=1e-4, expand_steps=1000, verbose=False):
+        # input is [num_conceptors, batch, dim], or [batch, dim] with labels that pick the conceptor of every row.
+        print("learn")
+
+        with torch.no_grad():
+            input = self.__internal__fit(input)
+            if labels is not None:
+                input, counts = self.__internal__group(input, labels)
+            else:
+                counts = torch.full([input.shape[0]], input.shape[1], dtype=torch.int64, device=self.device)
+
+            active = counts > 0
+            prev_loss = torch.zeros(self.weights.shape[0], device=self.device)
+            for k in range(expand_steps):
+
+                indices = torch.nonzero(active)[:, 0]
+                if indices.shape[0] == 0:
+                    break
+
+                x = input[indices]
+                W = self.weights[indices]
+                residue = x - torch.matmul(torch.matmul(x, W), torch.transpose(W, 1, 2))
+
+                rloss = torch.sum(residue * residue, dim=(1, 2)) / (counts[indices] * self.dim)
+                keep = (rloss >= expand_threshold) & (torch.abs(rloss - prev_loss[indices]) >= expand_threshold)
+
+                # expand
+                AA = torch.matmul(torch.transpose(residue, 1, 2), residue)
+                S, V = torch.linalg.eigh(AA)
+                S = torch.flip(S[:, -expand_depth:], dims=[1])
+                A = torch.flip(V[:, :, -expand_depth:], dims=[2])
+
+                check = S[:, expand_depth - 1]
+                keep = keep & (torch.abs(check) >= expand_threshold)
+
+                active[indices] = keep
+                if verbose:
+                    print("step:", k, "th, expanding", torch.sum(keep).item(), "conceptors, max loss:", torch.max(rloss).item())
+                if not torch.any(keep):
+                    break
+
+                # merge
+                self.__internal__append(indices[keep], A[keep], torch.sqrt(torch.clamp(S[keep], min=0)))
+                prev_loss[indices] = rloss
+
+    # ----------- public functions ---------------
+
+    def score(self, input):
+        # residual energy of every input under every conceptor, [batch, num_conceptors]; the bases are orthonormal.
+        with torch.no_grad():
+            input = self.__internal__fit(input)
+            codes = self << input
+            res = torch.unsqueeze(torch.sum(input * input, dim=1), 1) - torch.transpose(torch.sum(codes * codes, dim=2), 0, 1)
+        return torch.clamp(res, min=0)
+
+    def classify(self, input):
+        return torch.argmin(self.score(input), dim=1)
+
+    def __lshift__(self, input):
+        with torch.no_grad():
+            res = torch.matmul(self.__internal__fit(input), self.weights)
+        return res
+
+    def __rshift__(self, hidden):
+        with torch.no_grad():
+            res = torch.matmul(hidden, torch.transpose(self.weights, 1, 2))
+        return res
+
+
+if __name__ == '__main__':
+    print("assert conceptor bank classifies inputs by their subspace")
+
+    from linear import Conceptor
+
+    dtype = torch.float
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    num_classes = 20
+    dim = 64
+
+    # every class lives in its own random 5 dimensional subspace.
+    spaces = torch.linalg.qr(torch.randn(num_classes, dim, 5, device=device))[0]
+    y = torch.randint(num_classes, (2000, ), dtype=torch.int64, device=device)
+    x = torch.matmul(spaces[y], torch.randn(2000, 5, 1, device=device))[:, :, 0]
+
+    bank = Conceptor_Bank(device, num_classes, dim)
+    start = time.perf_counter()
+    bank.learn(x, y, expand_depth=1)
+    print("bank learn:", time.perf_counter() - start, "seconds, ranks:", bank.ranks.tolist())
+
+    start = time.perf_counter()
+    layers = [Conceptor(device) for c in range(num_classes)]
+    for c in range(num_classes):
+        layers[c].learn(x[y == c], 1)
+    print("separate learn:", time.perf_counter() - start, "seconds")
+
+    y_ = bank.classify(x)
+    print("Percent correct: ", torch.sum(y_ == y).item() * 100 / x.shape[0])
+
+    x_ = bank >> (bank << x)
+    print("reconstruction of own class:", torch.mean((x_[y, torch.arange(x.shape[0])] - x) ** 2).item())
@@ -0,0 +1,87 @@
+import collections
+import weakref
+
+
+class Code_Cache:
+    # codes of recent inputs, keyed by the identity of the tensor that started the chain (the root).
+    # an entry keeps the input it was computed from, so a layer can check that a new input only extends it.
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def get(self, root):
+        entry = self.entries.get(id(root))
+        if entry is None:
+            return None
+        ref, version, input, size, code = entry
+        if ref() is not root or version != root._version:
+            del self.entries[id(root)]
+            return None
+        self.entries.move_to_end(id(root))
+        return input, size, code
+
+    def put(self, root, input, size, code):
+        self.entries[id(root)] = (weakref.ref(root), root._version, input, size, code)
+        self.entries.move_to_end(id(root))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def reusable_prefix(self, input, cached):
+        # the width of cached that input still starts with, 0 when it does not.
+        if cached is input:
+            return input.shape[1]
+        if cached.shape[0] != input.shape[0] or cached.shape[2:] != input.shape[2:] or cached.shape[1] > input.shape[1]:
+            return 0
+        if not bool((input[:, 0:cached.shape[1], ...] == cached).all()):
+            return 0
+        return cached.shape[1]
+
+    def report(self):
+        return {"hits": self.hits, "extensions": self.extensions, "misses": self.misses}
+
+
+if __name__ == '__main__':
+    print("assert cached codes equal a plain << chain")
+
+    import torch
+    from main import Block_CMC, Block_LML, forward
+    from nearest import Nearest_Neighbor
+
+    dtype = torch.float
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    for name, blocks in [("Block_CMC", [Block_CMC(device) for i in range(2)]), ("Block_LML", [Block_LML(device) for i in range(2)])]:
+        final_layer = Nearest_Neighbor(device)
+        difference = 0.0
+        for step in range(12):
+            x = torch.rand(2, 1, 28, 28, device=device)
+            y = torch.randint(3, (2, ), dtype=torch.int64, device=device)
+
+            # the same order as main.run: test the new sample first, then learn it under the same root.
+            if step > 0:
+                prediction, hidden = forward(blocks, final_layer, x)
+                plain = x if name == "Block_CMC" else torch.reshape(x, [x.shape[0], -1])
+                for block in blocks:
+                    plain = block << plain
+                difference = max(difference, (hidden - plain).abs().max().item())
+
+            input = x
+            for block in blocks:
+                input = block.learn_cached(input, x)
+            final_layer.learn(torch.reshape(input, [input.shape[0], -1]), y, 3)
+
+            plain = x if name == "Block_CMC" else torch.reshape(x, [x.shape[0], -1])
+            for block in blocks:
+                plain = block << plain
+            difference = max(difference, (input - plain).abs().max().item())
+
+        print(name, "max difference:", difference)
+        for i, block in enumerate(blocks):
+            print(name, i, "cache:", block.cache_report())
@@ -0,0 +1,136 @@
+import torch
+
+
+def flatten(input):
+    return torch.reshape(input, [input.shape[0], -1])
+
+
+class Early_Exit_Cascade:
+    # runs blocks in order and stops for an input at the first attached head that is confident enough.
+    # a head is any readout with learn(input, output, num_classes) and confidence(input, criterion), like Nearest_Neighbor or Semantic_Memory.
+
+    def __init__(self, blocks, final_layer, threshold=0.5, criterion="ratio"):
+        self.blocks = blocks
+        self.final_layer = final_layer
+        self.heads = [None] * len(blocks)
+        self.threshold = threshold
+        self.criterion = criterion
+        self.reset_exits()
+
+    def attach(self, index, head):
+        self.heads[index] = head
+
+    def reset_exits(self):
+        # one count per block, the last entry counts inputs that reached the final layer.
+        self.exits = [0] * (len(self.blocks) + 1)
+
+    def learn(self, input, output, num_classes, root=None):
+        # pass the root that the inputs were encoded under before, so that blocks only encode with their new bases.
+        root = input if root is None else root
+        for block, head in zip(self.blocks, self.heads):
+            input = block.learn_cached(input, root)
+            if head is not None:
+                head.learn(flatten(input), output, num_classes)
+        self.final_layer.learn(flatten(input), output, num_classes)
+        return input
+
+    def trace(self, input):
+        # prediction and confidence of every head without exiting, the final layer gets an infinite confidence.
+        res = []
+        for block, head in zip(self.blocks, self.heads):
+            input = block << input
+            if head is not None:
+                res.append(head.confidence(flatten(input), self.criterion))
+            else:
+                res.append(None)
+        prediction = self.final_layer << flatten(input)
+        res.append((prediction, torch.full([prediction.shape[0]], float("inf"), device=prediction.device)))
+        return res
+
+    # ----------- public functions ---------------
+
+    def __lshift__(self, input):
+        prediction = None
+        remaining = torch.arange(input.shape[0], device=input.device)
+        for i, (block, head) in enumerate(zip(self.blocks, self.heads)):
+            input = block << input
+            if head is None:
+                continue
+
+            guess, score = head.confidence(flatten(input), self.criterion)
+            if prediction is None:
+                prediction = torch.zeros(remaining.shape[0], dtype=guess.dtype, device=guess.device)
+
+            done = score >= self.threshold
+            prediction[remaining[done]] = guess[done]
+            self.exits[i] = self.exits[i] + torch.sum(done).item()
+
+            remaining = remaining[~done]
+            input = input[~done]
+            if remaining.shape[0] == 0:
+                return prediction
+
+        guess = self.final_layer << flatten(input)
+        if prediction is None:
+            prediction = torch.zeros(remaining.shape[0], dtype=guess.dtype, device=guess.device)
+        prediction[remaining] = guess
+        self.exits[-1] = self.exits[-1] + remaining.shape[0]
+        return prediction
+
+
+def sweep_thresholds(traces, labels, thresholds):
+    # replays recorded traces for many thresholds, returns the exit distribution and the accuracy of each.
+    stages = [
+        (torch.cat([t[i][0] for t in traces], dim=0), torch.cat([t[i][1] for t in traces], dim=0))
+        for i in range(len(traces[0])) if traces[0][i] is not None
+    ]
+    exit_index = [i for i in range(len(traces[0])) if traces[0][i] is not None]
+    labels = torch.cat(labels, dim=0).to(stages[0][0].device)
+
+    res = []
+    for threshold in thresholds:
+        exits = [0] * len(traces[0])
+        prediction = torch.zeros_like(labels)
+        pending = torch.ones(labels.shape[0], dtype=torch.bool, device=labels.device)
+        for index, (guess, score) in zip(exit_index, stages):
+            done = pending & (score >= threshold)
+            prediction[done] = guess[done]
+            exits[index] = torch.sum(done).item()
+            pending = pending & ~done
+        res.append({
+            "threshold": threshold,
+            "exits": exits,
+            "accuracy": torch.sum(prediction == labels).item() * 100 / labels.shape[0]
+        })
+    return res
+
+
+if __name__ == '__main__':
+    print("assert early exit agrees with the full cascade when nothing exits")
+
+    from nearest import Nearest_Neighbor
+    from main import Block_CMC, forward
+
+    dtype = torch.float
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    blocks = [Block_CMC(device) for i in range(2)]
+    cascade = Early_Exit_Cascade(blocks, Nearest_Neighbor(device), threshold=float("inf"))
+    cascade.attach(0, Nearest_Neighbor(device))
+
+    x = torch.rand(10, 1, 28, 28, device=device)
+    y = torch.randint(3, (10, ), dtype=torch.int64, device=device)
+    cascade.learn(x, y, num_classes=3)
+
+    y_ = cascade << x
+    print("Agreement: ", torch.sum(y_ == forward(blocks, cascade.final_layer, x)[0]).item() * 100 / x.shape[0])
+    print("Exits: ", cascade.exits)
+
+    cascade.threshold = 0.5
+    cascade.reset_exits()
+    y_ = cascade << x
+    print("Exits: ", cascade.exits)
+    print("Percent correct: ", torch.sum(y_ == y).item() * 100 / x.shape[0])
+
+    for row in sweep_thresholds([cascade.trace(x)], [y], [0.0, 0.5, 0.9, float("inf")]):
+        print(row)
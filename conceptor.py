@@ -3,11 +3,13 @@ from layer import *
 import os
 import itertools
 import gc
+import workspace as ws
+from cache import Code_Cache
 
 
-class Cross_Correlational_Conceptor(Layer):
+class Cross_Correlational_Conceptor(Buffered_Learning, Layer):
 
-    def __init__(self, device, kernel_size=(3, 3), file_path=None):
+    def __init__(self, device, kernel_size=(3, 3), file_path=None, buffer_size=1, buffer_time=None, workspace=None):
         print("init")
         self.device = device
         self.weights = []
@@ -16,6 +18,10 @@ class Cross_Correlational_Conceptor(Layer):
         self.stride = kernel_size
         self.file_path = file_path
         self.max_input_channel = 0
+        self.buffer = Learning_Buffer(buffer_size, buffer_time)
+        self.workspace = workspace if workspace is not None else ws.shared
+        self.novelty_stats = Novelty_Stats()
+        self.code_cache = Code_Cache()
 
     def save(self):
         if self.file_path:
@@ -26,21 +32,25 @@ class Cross_Correlational_Conceptor(Layer):
             temp = torch.load(self.file_path)
             self.weights = temp["weights"]
             self.importances = temp["importances"]
+            self.code_cache.invalidate()
 
-    def __internal__assign_output_padding(self, input):
-        h = input.shape[2]
-        w = input.shape[3]
-
+    def __internal__assign_output_padding(self, h, w):
         self.output_padding = (self.kernel_size[0] - (h % self.kernel_size[0]), self.kernel_size[1] - (w % self.kernel_size[1]))
-        padded = torch.nn.functional.pad(input, (0, self.output_padding[1], 0, self.output_padding[0]))
-        return padded
 
     def __internal__perspective(self, input):
+        # every shifted copy and the output padding are written into one workspace buffer, release it after use.
         self.offsets = (0, 0)
-        res = torch.cat([
-            torch.nn.functional.pad(input, (x, self.kernel_size[1] - x, y, self.kernel_size[0] - y))
-            for (y, x) in itertools.product(range(self.kernel_size[0]), range(self.kernel_size[1]))
-        ], dim=0)
+        n = input.shape[0]
+        h = input.shape[2]
+        w = input.shape[3]
+        self.__internal__assign_output_padding(h + self.kernel_size[0], w + self.kernel_size[1])
+
+        res = self.workspace.acquire([
+            self.kernel_size[0] * self.kernel_size[1] * n, input.shape[1],
+            h + self.kernel_size[0] + self.output_padding[0], w + self.kernel_size[1] + self.output_padding[1]
+        ], self.device)
+        for i, (y, x) in enumerate(itertools.product(range(self.kernel_size[0]), range(self.kernel_size[1]))):
+            res[i * n:(i + 1) * n, :, y:y + h, x:x + w] = input
         return res
 
     def __internal__pool(self, input):
@@ -64,27 +74,36 @@ class Cross_Correlational_Conceptor(Layer):
         with torch.no_grad():
 
             input = self.__internal__perspective(input)
-            input = self.__internal__assign_output_padding(input)
+            residue = self.workspace.acquire(input.shape, self.device, zero=False)
 
             prev_size = len(self.weights)
             prev_loss = 0
             for k in range(expand_steps):
 
+                hidden = None
                 if len(self.weights) is not 0:
-                    hidden = self.__internal__forward(input, self.weights)
+                    hidden = self.__internal__forward(input, self.weights, out=self.__internal__get_hidden(input, self.weights))
                     input_ = self.__internal__backward(hidden, self.weights, input.shape[1])
                 else:
                     input_ = torch.zeros(1, input.shape[1], 1, 1, device=self.device)
 
-                residue = input - input_
+                torch.sub(input, input_, out=residue)
 
                 rloss = criterion(input_, input)
+                if hidden is not None:
+                    self.workspace.release(hidden)
+                    self.workspace.release(input_)
+
                 if rloss.item() < expand_threshold:
                     print("Stop expansion after", (len(self.weights) - prev_size) * expand_depth, "bases, small reconstruction loss.", rloss.item())
+                    self.workspace.release(residue)
+                    self.workspace.release(input)
                     return True
                 if abs(rloss.item() - prev_loss) < 1e-6:
                     print("Stop expansion after", (len(self.weights) - prev_size) * expand_depth, "bases, small delta error.", rloss.item(), prev_loss)
                     # del self.weights[len(self.weights) - k:]
+                    self.workspace.release(residue)
+                    self.workspace.release(input)
                     return False
 
                 # expand
@@ -115,6 +134,9 @@ class Cross_Correlational_Conceptor(Layer):
                 self.importances.append(M)
                 prev_loss = rloss.item()
 
+            self.workspace.release(residue)
+            self.workspace.release(input)
+
         gc.collect()
 
         return False
@@ -127,13 +149,22 @@ class Cross_Correlational_Conceptor(Layer):
         res = torch.mul(input, torch.reshape(torch.cat(importances, dim=0), [1, -1, 1, 1]))
         return res
 
-    def __internal__forward(self, input, weights):
+    def __internal__forward(self, input, weights, out=None):
         res = torch.cat([
             torch.nn.functional.conv2d(input[:, 0:f.shape[1], ...], f, stride=self.stride)
             for f in weights
-        ], dim=1)
+        ], dim=1, out=out)
         return res
 
+    def __internal__get_hidden(self, input, weights):
+        depth = 0
+        for f in weights:
+            depth = depth + f.shape[0]
+        return self.workspace.acquire([
+            input.shape[0], depth,
+            input.shape[2] // self.stride[0], input.shape[3] // self.stride[1]
+        ], self.device, zero=False)
+
     def __internal__get_canvas(self, hidden, weights, depth_out=0):
 
         h_out = hidden.shape[2] * self.kernel_size[0]
@@ -143,7 +174,7 @@ class Cross_Correlational_Conceptor(Layer):
         for f in weights:
             depth_out = max(depth_out, f.shape[1])
 
-        canvas = torch.zeros([hidden.shape[0], depth_out, h_out, w_out], device=self.device)
+        canvas = self.workspace.acquire([hidden.shape[0], depth_out, h_out, w_out], self.device)
         return canvas
 
     # https://github.com/vdumoulin/conv_arithmetic
@@ -163,14 +194,121 @@ class Cross_Correlational_Conceptor(Layer):
 
         return canvas
 
+    def __internal__stack(self, weights):
+        # every filter as one [bases, depth, kh, kw] tensor zero padded in depth, rebuilt only when the weights change.
+        key = (id(weights), len(weights))
+        if getattr(self, "stacked_key", None) != key:
+            depth = max([f.shape[1] for f in weights])
+            self.stacked = torch.cat([
+                torch.nn.functional.pad(f, (0, 0, 0, 0, 0, depth - f.shape[1]))
+                for f in weights
+            ], dim=0)
+            self.stacked_key = key
+        return self.stacked
+
+    def __internal__get_stacked_canvas(self, hidden, W):
+        return torch.zeros([
+            hidden.shape[0], max(W.shape[1], self.max_input_channel),
+            hidden.shape[2] * self.kernel_size[0], hidden.shape[3] * self.kernel_size[1]
+        ], device=self.device)
+
     # ----------- public functions ---------------
 
+    def stacked_weights(self):
+        # the filters exactly as << runs them, export.py writes these.
+        return self.__internal__stack(self.weights)
+
+    def novelty(self, input):
+        # per sample residual energy per element of the shifted copies, the same scale as the reconstruction loss in learn.
+        # filters are orthonormal over non-overlapping patches, so ||x||^2 - ||hidden||^2 is that residual.
+        with torch.no_grad():
+            nper = self.__internal__perspective(input)
+            energy = torch.sum(nper * nper, dim=(1, 2, 3))
+            if len(self.weights) != 0:
+                hidden = self.__internal__forward(nper, self.weights)
+                energy = energy - torch.sum(hidden * hidden, dim=(1, 2, 3))
+            size = nper.shape[1] * nper.shape[2] * nper.shape[3]
+            self.workspace.release(nper)
+            energy = torch.mean(torch.reshape(energy, [self.kernel_size[0] * self.kernel_size[1], -1]), dim=0)
+        return torch.clamp(energy, min=0) / size
+
+    def encode(self, input, rank=None, energy=None):
+        # like <<, but only the strongest bases are computed, the rest of the code stays zero.
+        selected = select_bases(self.importances, rank, energy)
+        if selected is None:
+            return self << input
+        with torch.no_grad():
+            W = self.__internal__stack(self.weights)
+            depth = min(input.shape[1], W.shape[1])
+            nper = self.__internal__perspective(input)
+            # pooling keeps the unshifted copy only, which is the first one.
+            hidden = torch.nn.functional.conv2d(nper[0:input.shape[0], 0:depth, ...], W[selected, 0:depth, ...], stride=self.stride)
+            self.workspace.release(nper)
+            res = torch.zeros(hidden.shape[0], W.shape[0], hidden.shape[2], hidden.shape[3], device=self.device)
+            res[:, selected, ...] = hidden
+        return res
+
+    def decode(self, hidden, rank=None, energy=None):
+        selected = select_bases(self.importances, rank, energy)
+        if selected is None:
+            return self >> hidden
+        with torch.no_grad():
+            W = self.__internal__stack(self.weights)
+            canvas = self.__internal__get_stacked_canvas(hidden, W)
+            canvas[:, 0:W.shape[1], ...] = torch.nn.functional.conv_transpose2d(hidden[:, selected, ...], W[selected, ...], stride=self.stride)
+            output = self.__internal__revert_output_padding(canvas)
+        return output
+
+    def decode_progressive(self, hidden, step=1):
+        # yields the reconstruction after adding the next step strongest bases, each from the previous one.
+        with torch.no_grad():
+            selected = torch.argsort(torch.cat(self.importances, dim=0), descending=True)
+            W = self.__internal__stack(self.weights)
+            canvas = self.__internal__get_stacked_canvas(hidden, W)
+            for i in range(0, selected.shape[0], step):
+                indices = selected[i:i + step]
+                canvas[:, 0:W.shape[1], ...] = canvas[:, 0:W.shape[1], ...] + torch.nn.functional.conv_transpose2d(hidden[:, indices, ...], W[indices, ...], stride=self.stride)
+                yield self.__internal__revert_output_padding(canvas).clone()
+
+    def encode_cached(self, input, root=None):
+        # like <<, the codes of bases that the last call with the same root already computed are reused.
+        root = input if root is None else root
+        with torch.no_grad():
+            start = 0
+            columns = 0
+            entry = self.code_cache.get(root)
+            if entry is not None:
+                cached, size, code = entry
+                width = self.code_cache.reusable_prefix(input, cached)
+                while start < size and self.weights[start].shape[1] <= width:
+                    columns = columns + self.weights[start].shape[0]
+                    start = start + 1
+
+            if start == 0:
+                self.code_cache.misses = self.code_cache.misses + 1
+                res = self << input
+            elif start == len(self.weights):
+                self.code_cache.hits = self.code_cache.hits + 1
+                res = code[:, 0:columns, ...]
+            else:
+                self.code_cache.extensions = self.code_cache.extensions + 1
+                nper = self.__internal__perspective(input)
+                # pooling keeps the unshifted copy only, which is the first one.
+                addition = self.__internal__forward(nper[0:input.shape[0], ...], self.weights[start:])
+                self.workspace.release(nper)
+                res = torch.cat([code[:, 0:columns, ...], addition], dim=1)
+
+            self.code_cache.put(root, input, len(self.weights), res)
+        return res
+
     def __lshift__(self, input):
         with torch.no_grad():
-            padded = self.__internal__perspective(input)
-            nper = self.__internal__assign_output_padding(padded)
-            hidden = self.__internal__forward(nper, self.weights)
-            pooled = self.__internal__pool(hidden)
+            nper = self.__internal__perspective(input)
+            # pooling keeps the unshifted copy only, which is the first one, so only that copy is convolved.
+            # one conv over the stacked filters gives the pooled codes directly, with no per block outputs to concatenate.
+            W = self.__internal__stack(self.weights)
+            pooled = torch.nn.functional.conv2d(nper[0:input.shape[0], 0:W.shape[1], ...], W, stride=self.stride)
+            self.workspace.release(nper)
             # output = self.__internal__scale(pooled, self.importances)
         return pooled
 
@@ -187,7 +325,7 @@ if __name__ == '__main__':
     print("assert conceptor preserves the containment property")
 
     dtype = torch.float
-    device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -225,3 +363,37 @@ if __name__ == '__main__':
 
     loss = criterion(x_, x1)
     print(loss.item())
+
+    print("assert encode and decode with every basis equal << and >>")
+
+    rank = sum([m.shape[0] for m in layer1.importances])
+    code = layer1 << x1
+    print((layer1.encode(x1, rank) - code).abs().max().item())
+    print((layer1.decode(code, rank) - (layer1 >> code)).abs().max().item())
+    print((list(layer1.decode_progressive(code, step=2))[-1] - (layer1 >> code)).abs().max().item())
+
+    # truncated codes keep only the strongest bases and reconstruct worse the fewer they keep.
+    for r in [1, rank // 2, rank]:
+        print("rank", r, "loss:", criterion(layer1.decode(layer1.encode(x1, r), r), x1).item())
+    print("energy 0.9 keeps", select_bases(layer1.importances, energy=0.9).shape[0], "of", rank, "bases")
+    try:
+        layer1.encode(x1, 0)
+    except ValueError as error:
+        print("ValueError:", error)
+
+    print("assert the novelty gate never leaves a layer without bases")
+
+    layer3 = Cross_Correlational_Conceptor(device, kernel_size=(3, 3))
+    x3 = torch.rand(1, 1, 28, 28, device=device) * 0.2
+    print(layer3.novelty(x3).item())
+
+    layer3.learn_novel(x3, 1, novelty_threshold=0.05)
+    print(len(layer3.weights) > 0, (layer3 << x3).shape)
+
+    # the first learn is timed too, so skipping the same sample again reports a positive saving.
+    for i in range(5):
+        layer3.learn_novel(x3, 1, novelty_threshold=0.05)
+    # nine bases span every 3x3 patch of one channel, only a sample with a new channel is novel; its batch mate is still skipped.
+    x4 = torch.cat([torch.nn.functional.pad(x3, (0, 0, 0, 0, 0, 1)), torch.rand(1, 2, 28, 28, device=device)], dim=0)
+    layer3.learn_novel(x4, 1, novelty_threshold=0.05)
+    print(layer3.novelty_stats.report())
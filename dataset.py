@@ -1,16 +1,46 @@
 import torch
-import torchvision
+import numpy as np
 import os
 import random
 
 root = os.path.dirname(os.path.abspath(__file__))
 
 
+def load_torchvision():
+    import torchvision
+    return torchvision.datasets.FashionMNIST(os.path.join(root, "data"), train=True, download=True, transform=torchvision.transforms.Compose([torchvision.transforms.ToTensor()]))
+
+
+def export_memmap(path=os.path.join(root, "data", "memmap")):
+    # raw images and labels as .npy files, so that many processes can map one copy.
+    import torchvision
+    dataset = torchvision.datasets.FashionMNIST(os.path.join(root, "data"), train=True, download=True)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "images.npy"), dataset.data.numpy())
+    np.save(os.path.join(path, "labels.npy"), dataset.targets.numpy())
+    return path
+
+
+class Memmap_Source:
+    # reads what export_memmap wrote, items look like the torchvision dataset with ToTensor.
+
+    def __init__(self, path=os.path.join(root, "data", "memmap")):
+        self.images = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, index):
+        datum = torch.from_numpy(self.images[index].astype(np.float32) / 255.0)
+        return torch.unsqueeze(datum, 0), torch.tensor(self.labels[index], dtype=torch.int64)
+
+
 class FashionMNIST:
-    def __init__(self, device, batch_size, max_per_class=100, seed=None, group_size=None):
+    def __init__(self, device, batch_size, max_per_class=100, seed=None, group_size=None, source=None):
         print("prepare dataset")
         self.batch_size = batch_size
-        self.dataset = torchvision.datasets.FashionMNIST(os.path.join(root, "data"), train=True, download=True, transform=torchvision.transforms.Compose([torchvision.transforms.ToTensor()]))
+        self.dataset = source if source is not None else load_torchvision()
 
         self.label_descriptions = {
             0: 'Top', 1: 'Trouser', 2: 'Pullover', 3: 'Dress', 4: 'Coat', 5: 'Sandal', 6: 'Shirt', 7: 'Sneaker', 8: 'Bag', 9: 'Boot'
@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+import time
+import subprocess
+import torch
+import numpy as np
+from conceptor import Cross_Correlational_Conceptor
+from linear import Conceptor
+from nearest import Nearest_Neighbor
+from transfer import Mirroring_Relu_Layer
+
+# writes learned layers as a manifest and .npy files for runtime.py, which runs them with numpy only.
+
+
+def flatten_layers(layers):
+    res = []
+    for layer in layers:
+        if hasattr(layer, "c0") and hasattr(layer, "t0") and hasattr(layer, "c1"):
+            res.extend([layer.c0, layer.t0, layer.c1])
+        else:
+            res.append(layer)
+    return res
+
+
+def save_array(path, name, tensor):
+    np.save(os.path.join(path, name), tensor.detach().cpu().numpy().astype(np.float32))
+    return name
+
+
+def export(path, layers, final_layer=None, input_shape=None):
+    # layers are conceptors, mirroring relu layers or blocks of them, in the order they encode.
+    os.makedirs(path, exist_ok=True)
+    specs = []
+    for i, layer in enumerate(flatten_layers(layers) + ([final_layer] if final_layer is not None else [])):
+        name = "layer_%d" % i
+        if hasattr(layer, "weights") and len(layer.weights) == 0:
+            raise ValueError("cannot export " + name + ", the " + type(layer).__name__ + " has not learned anything yet")
+        if isinstance(layer, Cross_Correlational_Conceptor):
+            specs.append({
+                "type": "cross_correlational_conceptor", "kernel_size": list(layer.kernel_size),
+                "weights": save_array(path, name + "_weights.npy", layer.stacked_weights())
+            })
+        elif isinstance(layer, Conceptor):
+            specs.append({"type": "conceptor", "weights": save_array(path, name + "_weights.npy", layer.stacked_weights())})
+        elif isinstance(layer, Mirroring_Relu_Layer):
+            specs.append({"type": "mirroring_relu"})
+        elif isinstance(layer, Nearest_Neighbor):
+            depth = max([A.shape[0] for (A, B) in layer.weights])
+            exemplars = torch.cat([
+                torch.transpose(torch.nn.functional.pad(A, (0, 0, 0, depth - A.shape[0])), 0, 1)
+                for (A, B) in layer.weights
+            ], dim=0)
+            labels = torch.cat([B for (A, B) in layer.weights], dim=0)
+            np.save(os.path.join(path, name + "_labels.npy"), labels.cpu().numpy())
+            specs.append({
+                "type": "nearest_neighbor",
+                "exemplars": save_array(path, name + "_exemplars.npy", exemplars),
+                "norms": save_array(path, name + "_norms.npy", torch.sum(exemplars * exemplars, dim=1)),
+                "labels": name + "_labels.npy"
+            })
+        else:
+            raise ValueError("cannot export " + type(layer).__name__)
+
+    manifest = {"layers": specs}
+    if input_shape is not None:
+        manifest["input_shape"] = list(input_shape)
+    with open(os.path.join(path, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return path
+
+
+if __name__ == '__main__':
+    print("assert numpy runtime matches the torch layers")
+
+    import tempfile
+    from main import Block_CMC, forward
+    from runtime import Runtime
+
+    dtype = torch.float
+    device = torch.device("cpu")
+
+    blocks = [Block_CMC(device) for i in range(2)]
+    final_layer = Nearest_Neighbor(device)
+
+    x = torch.rand(20, 1, 28, 28, device=device)
+    y = torch.randint(5, (20, ), dtype=torch.int64, device=device)
+    for i in range(0, x.shape[0], 5):
+        input = x[i:i + 5]
+        for block in blocks:
+            input = block <= input
+        final_layer.learn(torch.reshape(input, [input.shape[0], -1]), y[i:i + 5], num_classes=5)
+
+    path = export(os.path.join(tempfile.mkdtemp(), "stack"), blocks, final_layer, input_shape=[1, 1, 28, 28])
+    runtime = Runtime(path)
+
+    q = torch.rand(50, 1, 28, 28, device=device)
+    prediction, hidden = forward(blocks, final_layer, q)
+    hidden_ = runtime.encode(q.numpy())
+    prediction_ = runtime << q.numpy()
+
+    print("max code difference:", np.max(np.abs(hidden.numpy() - hidden_)))
+    print("Agreement: ", np.sum(prediction.numpy() == prediction_) * 100 / q.shape[0])
+    prediction_ = runtime << x.numpy()
+    print("Percent correct: ", np.sum(y.numpy() == prediction_) * 100 / x.shape[0])
+
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), "runtime.py"), path], capture_output=True, text=True)
+    print(result.stdout.strip())
+    print("cold start including the interpreter:", (time.perf_counter() - start) * 1000, "ms")
+
+    print("assert a stack without a final layer only encodes, and an empty layer is not exported")
+
+    runtime = Runtime(export(os.path.join(tempfile.mkdtemp(), "encoder"), blocks, input_shape=[1, 1, 28, 28]))
+    print("max code difference:", np.max(np.abs(hidden.numpy() - runtime.encode(q.numpy()))))
+    try:
+        runtime << q.numpy()
+    except ValueError as error:
+        print("ValueError:", error)
+    try:
+        export(os.path.join(tempfile.mkdtemp(), "empty"), [Block_CMC(device)])
+    except ValueError as error:
+        print("ValueError:", error)
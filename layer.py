@@ -1,4 +1,68 @@
 import torch
+import time
+
+
+class Learning_Buffer:
+    # collects samples until a sample or time budget is reached, so that a layer can expand once for many samples.
+
+    def __init__(self, max_samples=1, max_seconds=None):
+        self.max_samples = max_samples
+        self.max_seconds = max_seconds
+        self.samples = []
+        self.count = 0
+        self.start_time = None
+
+    def push(self, input):
+        if self.count == 0:
+            self.start_time = time.perf_counter()
+        self.samples.append(input)
+        self.count = self.count + input.shape[0]
+
+    def is_full(self):
+        if self.count >= self.max_samples:
+            return True
+        if self.max_seconds is not None and self.count > 0:
+            return time.perf_counter() - self.start_time >= self.max_seconds
+        return False
+
+    def drain(self):
+        # samples may have been produced while the previous layer was still growing, pad them to the widest.
+        depth = max([s.shape[1] for s in self.samples])
+        res = torch.cat([
+            torch.nn.functional.pad(s, [0, 0] * (s.dim() - 2) + [0, depth - s.shape[1]])
+            for s in self.samples
+        ], dim=0)
+        self.samples.clear()
+        self.count = 0
+        self.start_time = None
+        return res
+
+
+class Novelty_Stats:
+    # how many samples the novelty gate let through, and the time it cost and saved.
+
+    def __init__(self):
+        self.seen = 0
+        self.skipped = 0
+        self.learned = 0
+        self.learn_calls = 0
+        self.gate_time = 0.0
+        self.learn_time = 0.0
+
+    def report(self):
+        # saved time is the skipped samples at the average learn time per learned sample, unknown until something was learned.
+        saved_time = None
+        if self.learned > 0:
+            saved_time = self.skipped * self.learn_time / self.learned - self.gate_time
+        return {
+            "seen": self.seen,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.seen if self.seen > 0 else 0.0,
+            "learn_calls": self.learn_calls,
+            "gate_time": self.gate_time,
+            "learn_time": self.learn_time,
+            "saved_time": saved_time
+        }
 
 
 class Layer:
@@ -7,3 +71,61 @@ class Layer:
 
     def learn(self, input, expand_depth, expand_threshold=1e-6, steps=1000, lr=0.01):
         print("do nothing")
+
+
+class Buffered_Learning:
+    # for layers that expand their bases in learn, they need weights, a buffer (Learning_Buffer), novelty_stats (Novelty_Stats) and novelty(input).
+
+    def learn_buffered(self, input, expand_depth=1, **kwargs):
+        # encoding keeps using the current bases until the buffer is full, a layer without bases learns right away.
+        self.buffer.push(input)
+        if len(self.weights) != 0 and not self.buffer.is_full():
+            return False
+        return self.learn(self.buffer.drain(), expand_depth, **kwargs)
+
+    def learn_novel(self, input, expand_depth=1, novelty_threshold=None, **kwargs):
+        # samples that the current bases already explain to within novelty_threshold are not learned, without a threshold every sample is.
+        # a layer without bases must learn, or it has nothing to encode with; that learn is timed like every other.
+        self.novelty_stats.seen = self.novelty_stats.seen + input.shape[0]
+        if novelty_threshold is not None and len(self.weights) != 0:
+            start = time.perf_counter()
+            novel = self.novelty(input) >= novelty_threshold
+            count = torch.sum(novel).item()
+            self.novelty_stats.gate_time = self.novelty_stats.gate_time + time.perf_counter() - start
+            self.novelty_stats.skipped = self.novelty_stats.skipped + input.shape[0] - count
+
+            if count == 0:
+                return False
+            if count < input.shape[0]:
+                input = input[novel]
+
+        start = time.perf_counter()
+        res = self.learn_buffered(input, expand_depth, **kwargs)
+        self.novelty_stats.learn_time = self.novelty_stats.learn_time + time.perf_counter() - start
+        self.novelty_stats.learn_calls = self.novelty_stats.learn_calls + 1
+        self.novelty_stats.learned = self.novelty_stats.learned + input.shape[0]
+        return res
+
+    def flush(self, expand_depth=1, **kwargs):
+        if self.buffer.count == 0:
+            return False
+        return self.learn(self.buffer.drain(), expand_depth, **kwargs)
+
+
+def select_bases(importances, rank=None, energy=None):
+    # indices of the strongest bases over all blocks, strongest first; None keeps every basis in its stored order.
+    # energy is the fraction of the summed squared importances that the selected bases must reach.
+    if rank is None and energy is None:
+        return None
+    if rank is not None and rank < 1:
+        raise ValueError("rank must keep at least one basis, got " + str(rank))
+
+    values = torch.cat(importances, dim=0)
+    order = torch.argsort(values, descending=True)
+    count = values.shape[0]
+    if energy is not None:
+        cumulative = torch.cumsum(values[order] ** 2, dim=0)
+        count = min(torch.searchsorted(cumulative, energy * cumulative[-1]).item() + 1, count)
+    if rank is not None:
+        count = min(rank, count)
+    return order[:count]
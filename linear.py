@@ -1,17 +1,23 @@
 import torch
 from layer import *
 import os
+import workspace as ws
+from cache import Code_Cache
 
 
-class Conceptor(Layer):
+class Conceptor(Buffered_Learning, Layer):
 
-    def __init__(self, device, file_path=None):
+    def __init__(self, device, file_path=None, buffer_size=1, buffer_time=None, workspace=None):
         print("init")
         self.device = device
         self.weights = []
         self.importances = []
         self.file_path = file_path
         self.max_input_channel = 0
+        self.buffer = Learning_Buffer(buffer_size, buffer_time)
+        self.workspace = workspace if workspace is not None else ws.shared
+        self.novelty_stats = Novelty_Stats()
+        self.code_cache = Code_Cache()
 
     def save(self):
         if self.file_path:
@@ -22,6 +28,7 @@ class Conceptor(Layer):
             temp = torch.load(self.file_path)
             self.weights = temp["weights"]
             self.importances = temp["importances"]
+            self.code_cache.invalidate()
 
     def learn(self, input, expand_depth=1, expand_threshold=1e-4, expand_steps=1000, steps=1000, lr=0.01, verbose=False):
         print("learn")
@@ -32,19 +39,26 @@ class Conceptor(Layer):
 
         with torch.no_grad():
 
+            residue = self.workspace.acquire(input.shape, self.device, zero=False)
+
             prev_size = len(self.weights)
             prev_loss = 0
             for k in range(expand_steps):
 
+                hidden = None
                 if len(self.weights) is not 0:
-                    hidden = self.__internal__forward(input, self.weights)
+                    hidden = self.__internal__forward(input, self.weights, out=self.__internal__get_hidden(input, self.weights))
                     input_ = self.__internal__backward(hidden, self.weights, input.shape[1])
                 else:
                     input_ = torch.zeros(1, input.shape[1], device=self.device)
 
-                residue = input - input_
+                torch.sub(input, input_, out=residue)
 
                 rloss = criterion(input_, input)
+                if hidden is not None:
+                    self.workspace.release(hidden)
+                    self.workspace.release(input_)
+
                 if rloss.item() < expand_threshold:
                     print("Stop expansion after", (len(self.weights) - prev_size) * expand_depth, "steps, small reconstruction loss.", rloss.item())
                     break
@@ -74,6 +88,8 @@ class Conceptor(Layer):
                 self.importances.append(M)
                 prev_loss = rloss.item()
 
+            self.workspace.release(residue)
+
     def __internal__scale(self, input, importances):
         res = torch.div(input, torch.reshape(torch.cat(importances, dim=0), [1, -1]))
         return res
@@ -82,20 +98,26 @@ class Conceptor(Layer):
         res = torch.mul(input, torch.reshape(torch.cat(importances, dim=0), [1, -1]))
         return res
 
-    def __internal__forward(self, input, weights):
+    def __internal__forward(self, input, weights, out=None):
         res = torch.cat([
             torch.matmul(input[:, 0:f.shape[0]], f)
             for f in weights
-        ], dim=1)
+        ], dim=1, out=out)
         return res
 
+    def __internal__get_hidden(self, input, weights):
+        depth = 0
+        for f in weights:
+            depth = depth + f.shape[1]
+        return self.workspace.acquire([input.shape[0], depth], self.device, zero=False)
+
     def __internal__get_canvas(self, hidden, weights, depth_out=0):
 
         depth_out = max(depth_out, self.max_input_channel)
         for f in weights:
             depth_out = max(depth_out, f.shape[0])
 
-        canvas = torch.zeros([hidden.shape[0], depth_out], device=self.device)
+        canvas = self.workspace.acquire([hidden.shape[0], depth_out], self.device)
         return canvas
 
     def __internal__backward(self, hidden, weights, depth_out=0):
@@ -112,11 +134,98 @@ class Conceptor(Layer):
 
         return canvas
 
+    def __internal__stack(self, weights):
+        # every basis as one zero padded [depth, bases] matrix, rebuilt only when the weights change.
+        key = (id(weights), len(weights))
+        if getattr(self, "stacked_key", None) != key:
+            depth = max([f.shape[0] for f in weights])
+            self.stacked = torch.cat([
+                torch.nn.functional.pad(f, (0, 0, 0, depth - f.shape[0]))
+                for f in weights
+            ], dim=1)
+            self.stacked_key = key
+        return self.stacked
+
     # ----------- public functions ---------------
 
+    def stacked_weights(self):
+        # the filters exactly as << runs them, export.py writes these.
+        return self.__internal__stack(self.weights)
+
+    def novelty(self, input):
+        # per sample residual energy per dimension, ||x||^2 - ||W^T x||^2 holds because the bases are orthonormal.
+        with torch.no_grad():
+            energy = torch.sum(input * input, dim=1)
+            if len(self.weights) != 0:
+                hidden = self.__internal__forward(input, self.weights)
+                energy = energy - torch.sum(hidden * hidden, dim=1)
+        return torch.clamp(energy, min=0) / input.shape[1]
+
+    def encode(self, input, rank=None, energy=None):
+        # like <<, but only the strongest bases are computed, the rest of the code stays zero.
+        selected = select_bases(self.importances, rank, energy)
+        if selected is None:
+            return self << input
+        with torch.no_grad():
+            W = self.__internal__stack(self.weights)
+            depth = min(input.shape[1], W.shape[0])
+            res = torch.zeros(input.shape[0], W.shape[1], device=self.device)
+            res[:, selected] = torch.matmul(input[:, 0:depth], W[0:depth, selected])
+        return res
+
+    def decode(self, hidden, rank=None, energy=None):
+        selected = select_bases(self.importances, rank, energy)
+        if selected is None:
+            return self >> hidden
+        with torch.no_grad():
+            W = self.__internal__stack(self.weights)
+            canvas = torch.zeros(hidden.shape[0], max(W.shape[0], self.max_input_channel), device=self.device)
+            canvas[:, 0:W.shape[0]] = torch.matmul(hidden[:, selected], torch.transpose(W[:, selected], 0, 1))
+        return canvas
+
+    def decode_progressive(self, hidden, step=1):
+        # yields the reconstruction after adding the next step strongest bases, each from the previous one.
+        with torch.no_grad():
+            selected = torch.argsort(torch.cat(self.importances, dim=0), descending=True)
+            W = self.__internal__stack(self.weights)
+            canvas = torch.zeros(hidden.shape[0], max(W.shape[0], self.max_input_channel), device=self.device)
+            for i in range(0, selected.shape[0], step):
+                indices = selected[i:i + step]
+                canvas[:, 0:W.shape[0]] = canvas[:, 0:W.shape[0]] + torch.matmul(hidden[:, indices], torch.transpose(W[:, indices], 0, 1))
+                yield canvas.clone()
+
+    def encode_cached(self, input, root=None):
+        # like <<, the codes of bases that the last call with the same root already computed are reused.
+        root = input if root is None else root
+        with torch.no_grad():
+            start = 0
+            columns = 0
+            entry = self.code_cache.get(root)
+            if entry is not None:
+                cached, size, code = entry
+                width = self.code_cache.reusable_prefix(input, cached)
+                while start < size and self.weights[start].shape[0] <= width:
+                    columns = columns + self.weights[start].shape[1]
+                    start = start + 1
+
+            if start == 0:
+                self.code_cache.misses = self.code_cache.misses + 1
+                res = self.__internal__forward(input, self.weights)
+            elif start == len(self.weights):
+                self.code_cache.hits = self.code_cache.hits + 1
+                res = code[:, 0:columns]
+            else:
+                self.code_cache.extensions = self.code_cache.extensions + 1
+                res = torch.cat([code[:, 0:columns], self.__internal__forward(input, self.weights[start:])], dim=1)
+
+            self.code_cache.put(root, input, len(self.weights), res)
+        return res
+
     def __lshift__(self, input):
         with torch.no_grad():
-            res = self.__internal__forward(input, self.weights)
+            # one matmul over the stacked bases, with no per block outputs to concatenate.
+            W = self.__internal__stack(self.weights)
+            res = torch.matmul(input[:, 0:W.shape[0]], W)
             # output = self.__internal__scale(res, self.importances)
         return res
 
@@ -131,7 +240,7 @@ if __name__ == '__main__':
     print("assert conceptor preserves the containment property")
 
     dtype = torch.float
-    device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -166,3 +275,41 @@ if __name__ == '__main__':
 
     loss = criterion(x_, x1)
     print(loss.item())
+
+    print("assert encode and decode with every basis equal << and >>")
+
+    rank = sum([m.shape[0] for m in layer1.importances])
+    code = layer1 << x1
+    print((layer1.encode(x1, rank) - code).abs().max().item())
+    print((layer1.decode(code, rank) - (layer1 >> code)).abs().max().item())
+    print((list(layer1.decode_progressive(code, step=2))[-1] - (layer1 >> code)).abs().max().item())
+
+    # truncated codes keep only the strongest bases and reconstruct worse the fewer they keep.
+    for r in [1, rank // 2, rank]:
+        print("rank", r, "loss:", criterion(layer1.decode(layer1.encode(x1, r), r), x1).item())
+    print("energy 0.9 keeps", select_bases(layer1.importances, energy=0.9).shape[0], "of", rank, "bases")
+    try:
+        layer1.encode(x1, 0)
+    except ValueError as error:
+        print("ValueError:", error)
+
+    print("assert a buffered conceptor expands once per buffer_size samples")
+
+    layer3 = Conceptor(device, buffer_size=4)
+    x3 = torch.rand(10, 30, device=device)
+
+    expansions = 0
+    for i in range(x3.shape[0]):
+        size = len(layer3.weights)
+        layer3.learn_buffered(x3[i:i + 1], 1)
+        if layer3.buffer.count == 0:
+            expansions = expansions + 1
+        # an empty layer learns the first sample right away, later ones wait in the buffer and encode with the current bases.
+        print("sample", i, "bases:", size, "->", len(layer3.weights), "buffered:", layer3.buffer.count, "code:", (layer3 << x3[i:i + 1]).shape)
+    print("expansions:", expansions, "expected:", 1 + (x3.shape[0] - 1) // 4)
+
+    left = layer3.buffer.count
+    size = len(layer3.weights)
+    layer3.flush(1)
+    print("flush learns the", left, "samples left, bases:", size, "->", len(layer3.weights), "buffered:", layer3.buffer.count)
+    print(criterion(layer3 >> (layer3 << x3), x3).item())
@@ -1,29 +1,74 @@
+import argparse
+import multiprocessing
+import queue
+import time
 import torch
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
 from conceptor import Cross_Correlational_Conceptor
 from linear import Conceptor
 from nearest import Nearest_Neighbor
 from transfer import Mirroring_Relu_Layer
 from semantic import Semantic_Memory
-from dataset import FashionMNIST
+import workspace
+from cascade import Early_Exit_Cascade, sweep_thresholds
 
 
 class Block_LML:
-    def __init__(self):
-        self.c0 = Conceptor(device)
+    def __init__(self, device, expand_depth=1, expand_threshold=1e-4, buffer_size=1, buffer_time=None, novelty_threshold=None):
+        self.c0 = Conceptor(device, buffer_size=buffer_size, buffer_time=buffer_time)
         self.t0 = Mirroring_Relu_Layer(device)
-        self.c1 = Conceptor(device)
+        self.c1 = Conceptor(device, buffer_size=buffer_size, buffer_time=buffer_time)
+        self.expand_depth = expand_depth
+        self.expand_threshold = expand_threshold
+        self.novelty_threshold = novelty_threshold
 
     def __le__(self, input):
+        return self.learn_cached(input)
+
+    def learn_cached(self, input, root=None):
+        root = input if root is None else root
         input = torch.reshape(input, [input.shape[0], -1])
-        self.c0.learn(input, 1)
-        input = self.c0 << input
+        self.c0.learn_novel(input, self.expand_depth, novelty_threshold=self.novelty_threshold, expand_threshold=self.expand_threshold)
+        input = self.c0.encode_cached(input, root)
         input = self.t0 << input
 
-        self.c1.learn(input, 1)
-        output = self.c1 << input
+        self.c1.learn_novel(input, self.expand_depth, novelty_threshold=self.novelty_threshold, expand_threshold=self.expand_threshold)
+        output = self.c1.encode_cached(input, root)
+        return output
+
+    def encode_cached(self, input, root=None):
+        root = input if root is None else root
+        input = torch.reshape(input, [input.shape[0], -1])
+        input = self.c0.encode_cached(input, root)
+        input = self.t0 << input
+        output = self.c1.encode_cached(input, root)
+        return output
+
+    def flush(self):
+        self.c0.flush(self.expand_depth, expand_threshold=self.expand_threshold)
+        self.c1.flush(self.expand_depth, expand_threshold=self.expand_threshold)
+
+    def bases(self):
+        return [sum([m.shape[0] for m in c.importances]) for c in [self.c0, self.c1]]
+
+    def novelty_report(self):
+        return [c.novelty_stats.report() for c in [self.c0, self.c1]]
+
+    def cache_report(self):
+        return [c.code_cache.report() for c in [self.c0, self.c1]]
+
+    def encode(self, input, rank=None, energy=None):
+        input = torch.reshape(input, [input.shape[0], -1])
+        input = self.c0.encode(input, rank, energy)
+        input = self.t0 << input
+        output = self.c1.encode(input, rank, energy)
+        return output
+
+    def decode(self, hidden, rank=None, energy=None):
+        hidden = torch.reshape(hidden, [hidden.shape[0], -1])
+        hidden = self.c1.decode(hidden, rank, energy)
+        hidden = self.t0 >> hidden
+        output = self.c0.decode(hidden, rank, energy)
         return output
 
     def __lshift__(self, input):
@@ -40,18 +85,58 @@ class Block_LML:
 
 
 class Block_CMC:
-    def __init__(self):
-        self.c0 = Cross_Correlational_Conceptor(device, kernel_size=(3, 3))
+    def __init__(self, device, kernel_size=(3, 3), expand_depth=1, expand_threshold=1e-4, buffer_size=1, buffer_time=None, novelty_threshold=None):
+        self.c0 = Cross_Correlational_Conceptor(device, kernel_size=kernel_size, buffer_size=buffer_size, buffer_time=buffer_time)
         self.t0 = Mirroring_Relu_Layer(device)
-        self.c1 = Cross_Correlational_Conceptor(device, kernel_size=(1, 1))
+        self.c1 = Cross_Correlational_Conceptor(device, kernel_size=(1, 1), buffer_size=buffer_size, buffer_time=buffer_time)
+        self.expand_depth = expand_depth
+        self.expand_threshold = expand_threshold
+        self.novelty_threshold = novelty_threshold
 
     def __le__(self, input):
-        self.c0.learn(input, 1)
-        input = self.c0 << input
+        return self.learn_cached(input)
+
+    def learn_cached(self, input, root=None):
+        # the chain keeps one root, the input of the first block, so every layer can find its codes of that input.
+        root = input if root is None else root
+        self.c0.learn_novel(input, self.expand_depth, novelty_threshold=self.novelty_threshold, expand_threshold=self.expand_threshold)
+        input = self.c0.encode_cached(input, root)
         input = self.t0 << input
 
-        self.c1.learn(input, 1)
-        output = self.c1 << input
+        self.c1.learn_novel(input, self.expand_depth, novelty_threshold=self.novelty_threshold, expand_threshold=self.expand_threshold)
+        output = self.c1.encode_cached(input, root)
+        return output
+
+    def encode_cached(self, input, root=None):
+        root = input if root is None else root
+        input = self.c0.encode_cached(input, root)
+        input = self.t0 << input
+        output = self.c1.encode_cached(input, root)
+        return output
+
+    def flush(self):
+        self.c0.flush(self.expand_depth, expand_threshold=self.expand_threshold)
+        self.c1.flush(self.expand_depth, expand_threshold=self.expand_threshold)
+
+    def bases(self):
+        return [sum([m.shape[0] for m in c.importances]) for c in [self.c0, self.c1]]
+
+    def novelty_report(self):
+        return [c.novelty_stats.report() for c in [self.c0, self.c1]]
+
+    def cache_report(self):
+        return [c.code_cache.report() for c in [self.c0, self.c1]]
+
+    def encode(self, input, rank=None, energy=None):
+        input = self.c0.encode(input, rank, energy)
+        input = self.t0 << input
+        output = self.c1.encode(input, rank, energy)
+        return output
+
+    def decode(self, hidden, rank=None, energy=None):
+        hidden = self.c1.decode(hidden, rank, energy)
+        hidden = self.t0 >> hidden
+        output = self.c0.decode(hidden, rank, energy)
         return output
 
     def __lshift__(self, input):
@@ -67,36 +152,128 @@ class Block_CMC:
         return output
 
 
-if __name__ == "__main__":
-    print("main")
+def forward(cluster_layers, final_layer, input, rank=None, energy=None):
+    root = input
+    for cluster in cluster_layers:
+        if rank is None and energy is None:
+            input = cluster.encode_cached(input, root)
+        else:
+            input = cluster.encode(input, rank, energy)
+    logit = torch.reshape(input, [input.shape[0], -1])
+    prediction = final_layer << logit
+    return prediction, input
+
+
+def backward(cluster_layers, hidden, rank=None, energy=None):
+    for cluster in reversed(cluster_layers):
+        hidden = cluster.decode(hidden, rank, energy)
+    return hidden
+
+
+def preview_image(data, residue):
+    return np.reshape(np.concatenate([data.numpy(), residue], axis=3), [-1, residue.shape[3] * 2])
+
+
+def preview_worker(samples):
+    # runs in its own process so the learning loop never waits on the window.
+    import cv2
+    while True:
+        img = samples.get()
+        if img is None:
+            break
+        cv2.imshow("sample", img)
+        cv2.waitKey(1)
+    cv2.destroyAllWindows()
+
+
+def stop_viewer(viewer, samples, timeout=5):
+    # the viewer may have died (no cv2, no display, window closed) and left the bounded queue full, never wait on it for long.
+    if viewer.is_alive():
+        try:
+            samples.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+    viewer.join(timeout=timeout)
+    if viewer.is_alive():
+        viewer.terminate()
+        viewer.join()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Online learning of conceptor blocks on FashionMNIST.")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--max-per-class", type=int, default=20)
+    parser.add_argument("--group-size", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=10)
+    parser.add_argument("--blocks", type=int, default=3)
+    parser.add_argument("--kernel-size", type=int, nargs=2, default=[3, 3])
+    parser.add_argument("--expand-depth", type=int, default=1)
+    parser.add_argument("--expand-threshold", type=float, default=1e-4)
+    parser.add_argument("--buffer-size", type=int, default=1, help="samples each conceptor collects before it expands.")
+    parser.add_argument("--buffer-time", type=float, default=None, help="seconds after which a conceptor expands on whatever it has collected.")
+    parser.add_argument("--novelty-threshold", type=float, default=None, help="skip learning samples whose residual energy per element is below this.")
+    parser.add_argument("--exit-threshold", type=float, default=None, help="attach a nearest neighbor head to every block but the last and stop at the first head this confident.")
+    parser.add_argument("--exit-criterion", choices=["ratio", "margin"], default="ratio")
+    parser.add_argument("--headless", action="store_true", help="do not draw in the learning process.")
+    parser.add_argument("--preview-every", type=int, default=0, help="headless only, send a reconstruction to a viewer process every N steps (0 disables it).")
+    parser.add_argument("--report-every", type=int, default=50, help="print samples per second every N steps.")
+    return parser.parse_args(argv)
+
 
-    dtype = torch.float
-    device = torch.device("cuda:0")
+def run(args, source=None):
+    # the whole learn and test pipeline, sweep.py runs it for every configuration and keeps what it returns.
+    from dataset import FashionMNIST
 
-    batch_size = 1
-    dataset = FashionMNIST(device, batch_size=batch_size, max_per_class=20, seed=10, group_size=2)
+    device = torch.device(args.device)
+    batch_size = args.batch_size
+    dataset = FashionMNIST(device, batch_size=batch_size, max_per_class=args.max_per_class, seed=args.seed, group_size=args.group_size, source=source)
 
     cluster_layers = []
 
-    for i in range(3):
-        cluster_layers.append(Block_CMC())
+    for i in range(args.blocks):
+        cluster_layers.append(Block_CMC(
+            device, kernel_size=tuple(args.kernel_size), expand_depth=args.expand_depth, expand_threshold=args.expand_threshold,
+            buffer_size=args.buffer_size, buffer_time=args.buffer_time, novelty_threshold=args.novelty_threshold))
 
     # final_layer = Semantic_Memory(device)
     final_layer = Nearest_Neighbor(device)
 
-    def forward(input):
-        for cluster in cluster_layers:
-            input = cluster << input
-        logit = torch.reshape(input, [input.shape[0], -1])
-        prediction = final_layer << logit
-        return prediction, input
+    cascade = Early_Exit_Cascade(cluster_layers, final_layer, args.exit_threshold, args.exit_criterion)
+    if args.exit_threshold is not None:
+        for i in range(len(cluster_layers) - 1):
+            cascade.attach(i, Nearest_Neighbor(device))
 
-    def backward(hidden):
-        for cluster in reversed(cluster_layers):
-            hidden = cluster >> hidden
-        return hidden
+    show = None
+    samples = None
+    viewer = None
+    preview_every = 0
+    if not args.headless:
+        import cv2
+        preview_every = 1
+
+        def show(img):
+            cv2.imshow("sample", img)
+            cv2.waitKey(10)
+    elif args.preview_every > 0:
+        preview_every = args.preview_every
+        context = multiprocessing.get_context("spawn")
+        samples = context.Queue(maxsize=2)
+        viewer = context.Process(target=preview_worker, args=(samples,), daemon=True)
+        viewer.start()
+
+        def show(img):
+            if not viewer.is_alive():
+                return
+            try:
+                samples.put_nowait(img)
+            except queue.Full:
+                pass
 
     percent_correct = 0.0
+    start_time = time.perf_counter()
+    report_time = start_time
+    report_count = 0
     for i, (data, label) in enumerate(dataset):
         print("data: ", i)
 
@@ -106,7 +283,7 @@ if __name__ == "__main__":
         # online test
         current_bits = 0
         if i > 0:
-            prediction, hidden = forward(input)
+            prediction, hidden = forward(cluster_layers, final_layer, input)
             prediction = prediction.cpu()
             count_correct = np.sum(prediction.numpy() == label.numpy())
             percent_correct = 0.99 * percent_correct + 0.01 * count_correct * 100 / batch_size
@@ -116,26 +293,70 @@ if __name__ == "__main__":
             current_bits = hidden.shape[1]
 
         # then, learn
-        for cluster in cluster_layers:
-            input = cluster <= input
-        logits = torch.reshape(input, [input.shape[0], -1])
-        final_layer.learn(logits, output, 10)
-        prediction = final_layer << logits
-
-        residue = input.clone().detach()
-        residue[:, :current_bits, ...] = 0
-        residue = torch.abs(backward(residue)).cpu().numpy()
-        img = np.reshape(np.concatenate([data.numpy(), residue], axis=3), [-1, residue.shape[3] * 2])
-        cv2.imshow("sample", img)
-        cv2.waitKey(10)
+        input = cascade.learn(input, output, 10, root=input)
+
+        if preview_every > 0 and i % preview_every == 0:
+            residue = input.clone().detach()
+            residue[:, :current_bits, ...] = 0
+            residue = torch.abs(backward(cluster_layers, residue)).cpu().numpy()
+            show(preview_image(data, residue))
+
+        report_count = report_count + batch_size
+        if args.report_every > 0 and (i + 1) % args.report_every == 0:
+            now = time.perf_counter()
+            print("Samples per second: ", report_count / (now - report_time))
+            report_time = now
+            report_count = 0
+
+    for cluster in cluster_layers:
+        cluster.flush()
+
+    learn_time = time.perf_counter() - start_time
+    print("Learning samples per second: ", len(dataset) * batch_size / learn_time)
+    if args.novelty_threshold is not None:
+        for i, cluster in enumerate(cluster_layers):
+            print("Novelty gate of block", i, ":", cluster.novelty_report())
+
+    if samples is not None:
+        stop_viewer(viewer, samples)
 
     count = 0
+    start_time = time.perf_counter()
     for i, (data, label) in enumerate(dataset):
         input = data.to(device)
         output = label.to(device)
 
         # test
-        prediction = forward(input)[0].cpu()
+        prediction = (cascade << input).cpu()
         count = count + np.sum(prediction.numpy() == label.numpy())
 
-    print("Percent correct: ", count * 100 / (len(dataset) * batch_size))
+    inference_time = time.perf_counter() - start_time
+    accuracy = count * 100 / (len(dataset) * batch_size)
+    print("Inference samples per second: ", len(dataset) * batch_size / inference_time)
+    print("Percent correct: ", accuracy)
+
+    if args.exit_threshold is not None:
+        print("Exits per block: ", cascade.exits)
+        traces = []
+        labels = []
+        for i, (data, label) in enumerate(dataset):
+            traces.append(cascade.trace(data.to(device)))
+            labels.append(label)
+        for row in sweep_thresholds(traces, labels, [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, float("inf")]):
+            print("Threshold: ", row["threshold"], "exits: ", row["exits"], "percent correct: ", row["accuracy"])
+    print("Workspace: ", workspace.shared.report())
+    for i, cluster in enumerate(cluster_layers):
+        print("Code cache of block", i, ":", cluster.cache_report())
+
+    return {
+        "accuracy": accuracy,
+        "bases": [cluster.bases() for cluster in cluster_layers],
+        "learn_time": learn_time,
+        "inference_time": inference_time
+    }
+
+
+if __name__ == "__main__":
+    print("main")
+
+    run(parse_args())
@@ -38,6 +38,29 @@ class Nearest_Neighbor(Layer):
 
     # ----------- public functions ---------------
 
+    def confidence(self, input, criterion="ratio"):
+        # ratio: 1 - distance to the nearest exemplar over distance to the nearest exemplar of another class.
+        # margin: the difference of the two squared distances.
+        with torch.no_grad():
+            distances = torch.clamp(2 * torch.sum(input * input, dim=1, keepdim=True) - self.__internal__forward(input, self.weights), min=0)
+
+            bases = torch.cat([
+                B for (A, B) in self.weights
+            ], dim=0)
+
+            nearest, indices = torch.min(distances, dim=1)
+            prediction = bases[indices]
+
+            others = torch.where(torch.unsqueeze(bases, 0) == torch.unsqueeze(prediction, 1), torch.full_like(distances, float("inf")), distances)
+            second = torch.min(others, dim=1)[0]
+
+            if criterion == "margin":
+                score = second - nearest
+            else:
+                score = 1 - torch.sqrt(nearest) / torch.clamp(torch.sqrt(second), min=1e-12)
+
+        return prediction, score
+
     def __lshift__(self, input):
         with torch.no_grad():
             logits_ = self.__internal__forward(input, self.weights)
@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# inference over a stack written by export.py, with numpy only so that a short lived process starts in milliseconds.
+
+
+def load_array(path, name):
+    return np.load(os.path.join(path, name), mmap_mode="r")
+
+
+class Conceptor:
+
+    def __init__(self, path, spec):
+        self.weights = load_array(path, spec["weights"])
+
+    def __lshift__(self, input):
+        input = np.reshape(input, [input.shape[0], -1])
+        depth = min(input.shape[1], self.weights.shape[0])
+        return np.matmul(input[:, 0:depth], self.weights[0:depth])
+
+
+class Cross_Correlational_Conceptor:
+
+    def __init__(self, path, spec):
+        self.kernel_size = tuple(spec["kernel_size"])
+        self.weights = load_array(path, spec["weights"])
+
+    def __lshift__(self, input):
+        # the same as the torch layer: shift padding, output padding, then a conv with stride equal to the kernel over the unshifted copy.
+        n, c, h, w = input.shape
+        kh, kw = self.kernel_size
+        hp = h + kh + kh - ((h + kh) % kh)
+        wp = w + kw + kw - ((w + kw) % kw)
+        depth = min(c, self.weights.shape[1])
+
+        padded = np.zeros([n, depth, hp, wp], dtype=np.float32)
+        padded[:, :, 0:h, 0:w] = input[:, 0:depth]
+
+        patches = np.reshape(padded, [n, depth, hp // kh, kh, wp // kw, kw])
+        patches = np.reshape(np.transpose(patches, [0, 2, 4, 1, 3, 5]), [-1, depth * kh * kw])
+        filters = np.reshape(self.weights[:, 0:depth], [self.weights.shape[0], -1])
+        res = np.matmul(patches, np.transpose(filters))
+        return np.transpose(np.reshape(res, [n, hp // kh, wp // kw, -1]), [0, 3, 1, 2])
+
+
+class Mirroring_Relu_Layer:
+
+    def __init__(self, path, spec):
+        pass
+
+    def __lshift__(self, input):
+        res = np.stack([np.maximum(input, 0), np.maximum(-input, 0)], axis=2)
+        shape = list(input.shape)
+        shape[1] = -1
+        return np.reshape(res, shape)
+
+
+class Nearest_Neighbor:
+
+    def __init__(self, path, spec):
+        self.exemplars = load_array(path, spec["exemplars"])
+        self.norms = load_array(path, spec["norms"])
+        self.labels = load_array(path, spec["labels"])
+
+    def __lshift__(self, input):
+        # a query wider than every exemplar only adds a constant to its distances.
+        input = np.reshape(input, [input.shape[0], -1])
+        depth = min(input.shape[1], self.exemplars.shape[1])
+        distances = self.norms - 2 * np.matmul(input[:, 0:depth], np.transpose(self.exemplars[:, 0:depth]))
+        return self.labels[np.argmin(distances, axis=1)]
+
+
+layer_types = {
+    "conceptor": Conceptor,
+    "cross_correlational_conceptor": Cross_Correlational_Conceptor,
+    "mirroring_relu": Mirroring_Relu_Layer,
+    "nearest_neighbor": Nearest_Neighbor
+}
+
+
+class Runtime:
+
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json")) as file:
+            self.manifest = json.load(file)
+        self.layers = [layer_types[spec["type"]](path, spec) for spec in self.manifest["layers"]]
+        self.final_layer = None
+        if len(self.layers) > 0 and isinstance(self.layers[-1], Nearest_Neighbor):
+            self.final_layer = self.layers.pop()
+
+    def encode(self, input):
+        input = np.asarray(input, dtype=np.float32)
+        for layer in self.layers:
+            input = layer << input
+        return input
+
+    def __lshift__(self, input):
+        if self.final_layer is None:
+            raise ValueError("the manifest has no nearest_neighbor final layer, only encode is available")
+        return self.final_layer << self.encode(input)
+
+
+if __name__ == '__main__':
+    print("assert runtime starts without torch")
+
+    start = time.perf_counter()
+    runtime = Runtime(sys.argv[1])
+    loaded = time.perf_counter()
+
+    x = np.random.rand(*runtime.manifest.get("input_shape", [1, 1, 28, 28])).astype(np.float32)
+    prediction = runtime << x if runtime.final_layer is not None else runtime.encode(x)
+    done = time.perf_counter()
+
+    print("load:", (loaded - start) * 1000, "ms, first prediction:", (done - loaded) * 1000, "ms")
+    print("torch imported:", "torch" in sys.modules)
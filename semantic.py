@@ -81,6 +81,22 @@ class Semantic_Memory(Layer):
 
     # ----------- public functions ---------------
 
+    def confidence(self, input, criterion="ratio"):
+        # ratio: 1 - second best over best class probability, margin: best minus second best probability.
+        with torch.no_grad():
+            logits_ = self.__internal__forward(input, self.weights)
+            probs = torch.softmax(logits_, dim=1)
+            top, prediction = torch.topk(probs, min(2, probs.shape[1]), dim=1)
+            prediction = prediction[:, 0]
+            second = top[:, 1] if top.shape[1] > 1 else torch.zeros_like(top[:, 0])
+
+            if criterion == "margin":
+                score = top[:, 0] - second
+            else:
+                score = 1 - second / top[:, 0]
+
+        return prediction, score
+
     def __lshift__(self, input):
         with torch.no_grad():
             logits_ = self.__internal__forward(input, self.weights)
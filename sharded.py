@@ -0,0 +1,210 @@
+import torch
+import torch.multiprocessing as mp
+import math
+import queue
+import time
+from layer import Layer
+
+
+def shard_worker(requests, results, bank, norms, labels, count, threads):
+    torch.set_num_threads(threads)
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        if message[0] == "bank":
+            bank, norms, labels = message[1:]
+            continue
+
+        query, k = message[1:]
+        n = count.item()
+        if n == 0:
+            results.put((torch.empty(query.shape[0], 0), torch.empty(query.shape[0], 0, dtype=torch.int64)))
+            continue
+
+        distances = torch.sum(query * query, dim=1, keepdim=True) - 2 * torch.matmul(query, torch.transpose(bank[:n], 0, 1)) + norms[:n]
+        values, indices = torch.topk(distances, min(k, n), dim=1, largest=False)
+        results.put((values, labels[:n][indices]))
+
+
+class Sharded_Nearest_Neighbor(Layer):
+    # same readout as Nearest_Neighbor, but the exemplars are split over worker processes that read them from shared memory.
+    # exemplars and queries are zero padded to a common dim, a query wider than every exemplar only adds a constant to its distances.
+
+    def __init__(self, device, dim=1, num_shards=4, capacity=1024, threads=1, timeout=5):
+        print("init")
+        self.device = device
+        self.dim = dim
+        self.threads = threads
+        # seconds between checks that a shard we wait on is still alive, and how long close waits for a shard to exit.
+        self.timeout = timeout
+        self.context = mp.get_context("spawn")
+        self.shards = []
+        for i in range(num_shards):
+            bank, norms, labels = self.__internal__allocate(capacity, dim)
+            count = torch.zeros(1, dtype=torch.int64).share_memory_()
+            requests = self.context.Queue()
+            results = self.context.Queue()
+            process = self.context.Process(target=shard_worker, args=(requests, results, bank, norms, labels, count, threads), daemon=True)
+            process.start()
+            self.shards.append({
+                "bank": bank, "norms": norms, "labels": labels, "count": count, "size": 0,
+                "requests": requests, "results": results, "process": process
+            })
+
+    def __internal__allocate(self, capacity, dim):
+        bank = torch.zeros(capacity, dim).share_memory_()
+        norms = torch.zeros(capacity).share_memory_()
+        labels = torch.zeros(capacity, dtype=torch.int64).share_memory_()
+        return bank, norms, labels
+
+    def __internal__grow(self, shard, capacity, dim):
+        bank, norms, labels = self.__internal__allocate(capacity, dim)
+        size = shard["size"]
+        bank[:size, :shard["bank"].shape[1]] = shard["bank"][:size]
+        norms[:size] = shard["norms"][:size]
+        labels[:size] = shard["labels"][:size]
+        shard["bank"] = bank
+        shard["norms"] = norms
+        shard["labels"] = labels
+        shard["requests"].put(("bank", bank, norms, labels))
+
+    def __internal__fit(self, input):
+        input = input.detach().to("cpu", torch.float)
+        if input.shape[1] > self.dim:
+            return input[:, :self.dim].contiguous()
+        return torch.nn.functional.pad(input, (0, self.dim - input.shape[1]))
+
+    def __internal__check(self, shard, index):
+        if not shard["process"].is_alive():
+            raise RuntimeError("shard %d (pid %d) died with exit code %s" % (index, shard["process"].pid, shard["process"].exitcode))
+
+    def __internal__gather(self, shard, index):
+        # a dead worker never answers, so wait in steps and check it in between.
+        while True:
+            try:
+                return shard["results"].get(timeout=self.timeout)
+            except queue.Empty:
+                self.__internal__check(shard, index)
+
+    def __len__(self):
+        return sum([shard["size"] for shard in self.shards])
+
+    def learn(self, input, output, num_classes, expand_threshold=1e-2, steps=1000, lr=0.01):
+        print("learn")
+
+        if input.shape[1] > self.dim:
+            self.dim = input.shape[1]
+            for shard in self.shards:
+                self.__internal__grow(shard, shard["bank"].shape[0], self.dim)
+
+        input = self.__internal__fit(input)
+        output = output.detach().to("cpu", torch.int64)
+
+        # big batches are split so that no shard takes all of them, each chunk goes to the least loaded shard.
+        chunk_size = math.ceil(input.shape[0] / len(self.shards))
+        for chunk, labels in zip(torch.split(input, chunk_size), torch.split(output, chunk_size)):
+            shard = min(self.shards, key=lambda s: s["size"])
+            size = shard["size"]
+            if size + chunk.shape[0] > shard["bank"].shape[0]:
+                self.__internal__grow(shard, max(2 * shard["bank"].shape[0], size + chunk.shape[0]), self.dim)
+
+            shard["bank"][size:size + chunk.shape[0]] = chunk
+            shard["norms"][size:size + chunk.shape[0]] = torch.sum(chunk * chunk, dim=1)
+            shard["labels"][size:size + chunk.shape[0]] = labels
+            shard["size"] = size + chunk.shape[0]
+            shard["count"].fill_(shard["size"])
+
+    def topk(self, input, k=1):
+        with torch.no_grad():
+            query = self.__internal__fit(input).share_memory_()
+            for i, shard in enumerate(self.shards):
+                self.__internal__check(shard, i)
+            for shard in self.shards:
+                shard["requests"].put(("query", query, k))
+
+            partials = [self.__internal__gather(shard, i) for i, shard in enumerate(self.shards)]
+            distances = torch.cat([d for (d, l) in partials], dim=1)
+            labels = torch.cat([l for (d, l) in partials], dim=1)
+
+            values, indices = torch.topk(distances, min(k, distances.shape[1]), dim=1, largest=False)
+            labels = torch.gather(labels, 1, indices)
+
+        return values.to(self.device), labels.to(self.device)
+
+    def close(self):
+        # same as stopping the viewer in main.py, a dead or stuck shard must not keep close from returning.
+        for shard in self.shards:
+            if shard["process"].is_alive():
+                shard["requests"].put(None)
+        for shard in self.shards:
+            shard["process"].join(timeout=self.timeout)
+            if shard["process"].is_alive():
+                shard["process"].terminate()
+                shard["process"].join()
+
+    # ----------- public functions ---------------
+
+    def __lshift__(self, input):
+        values, labels = self.topk(input, 1)
+        return labels[:, 0]
+
+
+if __name__ == '__main__':
+    print("assert sharded nearest neighbor agrees with nearest neighbor")
+
+    from nearest import Nearest_Neighbor
+
+    dtype = torch.float
+    device = torch.device("cpu")
+
+    single = Nearest_Neighbor(device)
+    layer = Sharded_Nearest_Neighbor(device, dim=392, num_shards=4)
+
+    x = torch.randn(1000, 392, device=device)
+    y = torch.randint(5, (1000, ), dtype=torch.int64, device=device)
+
+    single.learn(x, y, num_classes=5)
+    layer.learn(x, y, num_classes=5)
+
+    x2 = torch.randn(2000, 784, device=device)
+    y2 = torch.randint(10, (2000, ), dtype=torch.int64, device=device)
+
+    single.learn(x2, y2, num_classes=10)
+    for i in range(20):
+        layer.learn(x2[i * 100:(i + 1) * 100], y2[i * 100:(i + 1) * 100], num_classes=10)
+    print("shard sizes:", [shard["size"] for shard in layer.shards])
+
+    q = torch.zeros(x.shape[0], x2.shape[1], device=device)
+    q[:, 0:x.shape[1], ...] = x
+
+    start = time.perf_counter()
+    y_single = single << q
+    print("single process:", time.perf_counter() - start, "seconds")
+
+    # the first query waits for the workers to start up.
+    y_ = layer << q
+    start = time.perf_counter()
+    y_ = layer << q
+    print("sharded:", time.perf_counter() - start, "seconds")
+
+    print("Agreement: ", torch.sum(y_ == y_single).item() * 100 / q.shape[0])
+    print("Percent correct: ", torch.sum(y_ == y).item() * 100 / x.shape[0])
+
+    layer.close()
+
+    print("assert a dead shard raises instead of hanging")
+
+    layer = Sharded_Nearest_Neighbor(device, dim=392, num_shards=4)
+    layer.learn(x, y, num_classes=5)
+    y_ = layer << x
+    layer.shards[1]["process"].kill()
+    layer.shards[1]["process"].join()
+    try:
+        y_ = layer << x
+    except RuntimeError as error:
+        print("RuntimeError:", error)
+
+    start = time.perf_counter()
+    layer.close()
+    print("close:", time.perf_counter() - start, "seconds")
@@ -0,0 +1,108 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import torch
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+default_grid = {
+    "kernel_size": [[3, 3]],
+    "blocks": [3],
+    "expand_depth": [1],
+    "expand_threshold": [1e-4],
+    "max_per_class": [20],
+    "group_size": [2],
+    "seed": [10],
+    "batch_size": [1],
+    "buffer_size": [1],
+    "buffer_time": [None],
+    "novelty_threshold": [None],
+    "exit_threshold": [None],
+    "exit_criterion": ["ratio"]
+}
+
+columns = ["run"] + list(default_grid.keys()) + ["accuracy", "bases", "learn_time", "inference_time"]
+
+
+def expand_grid(grid):
+    unknown = [k for k in grid if k not in default_grid]
+    if len(unknown) > 0:
+        raise ValueError("unknown grid keys " + ", ".join(unknown) + ", expected some of " + ", ".join(default_grid.keys()))
+    config = dict(default_grid)
+    config.update(grid)
+    keys = list(config.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[config[k] for k in keys])]
+
+
+def run_config(job):
+    index, config, data_path, device, threads, log_dir = job
+
+    # every worker maps the same files, the pages are shared between processes.
+    from dataset import Memmap_Source
+    import main
+
+    torch.set_num_threads(threads)
+    torch.manual_seed(config["seed"])
+
+    # the grid keys are main.py's options, so every run goes through main.run, headless and without a viewer.
+    args = main.parse_args(["--headless", "--device", device, "--report-every", "0"])
+    for key, value in config.items():
+        setattr(args, key, value)
+
+    with open(os.path.join(log_dir, "run_%d.log" % index), "w") as log, contextlib.redirect_stdout(log):
+        result = dict(config)
+        result["run"] = index
+        result.update(main.run(args, source=Memmap_Source(data_path)))
+    return result
+
+
+def sweep(grid, data_path, output_path, workers, device="cpu", threads=1):
+    configs = expand_grid(grid)
+    log_dir = os.path.splitext(output_path)[0] + "_logs"
+    os.makedirs(log_dir, exist_ok=True)
+    jobs = [(i, config, data_path, device, threads, log_dir) for i, config in enumerate(configs)]
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with open(output_path, "w", newline="") as file, context.Pool(workers) as pool:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for result in pool.imap_unordered(run_config, jobs):
+            writer.writerow({k: json.dumps(v) if isinstance(v, list) else v for k, v in result.items()})
+            file.flush()
+            print("run", result["run"], "of", len(jobs), "accuracy:", result["accuracy"], "learn time:", result["learn_time"], "inference time:", result["inference_time"])
+            results.append(result)
+
+    return sorted(results, key=lambda r: r["run"])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run main.py configurations over a process pool.")
+    parser.add_argument("--grid", default=None, help="json file that maps parameter names to lists of values.")
+    parser.add_argument("--data", default=os.path.join(root, "data", "memmap"), help="directory written by dataset.export_memmap.")
+    parser.add_argument("--output", default=os.path.join(root, "artifacts", "sweep.csv"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker.")
+    parser.add_argument("--device", default="cpu")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print("sweep")
+
+    args = parse_args()
+
+    grid = {}
+    if args.grid is not None:
+        with open(args.grid) as file:
+            grid = json.load(file)
+
+    if not os.path.exists(os.path.join(args.data, "images.npy")):
+        from dataset import export_memmap
+        export_memmap(args.data)
+
+    sweep(grid, args.data, args.output, args.workers, args.device, args.threads)
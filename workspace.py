@@ -0,0 +1,117 @@
+import torch
+import collections
+
+
+class Workspace:
+    # hands out reusable buffers keyed by shape, dtype and device; released buffers are kept until max_bytes, least recently used first out.
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.free = collections.OrderedDict()
+        self.held_bytes = 0
+        self.reset_report()
+
+    def __internal__key(self, shape, dtype, device):
+        return (tuple(shape), dtype, str(device))
+
+    def acquire(self, shape, device, dtype=torch.float, zero=True):
+        key = self.__internal__key(shape, dtype, device)
+        pool = self.free.get(key)
+        if pool:
+            res = pool.pop()
+            if len(pool) == 0:
+                del self.free[key]
+            self.held_bytes = self.held_bytes - res.element_size() * res.nelement()
+            self.reuses = self.reuses + 1
+            if zero:
+                res.zero_()
+            return res
+
+        self.allocations = self.allocations + 1
+        if zero:
+            res = torch.zeros(shape, dtype=dtype, device=device)
+        else:
+            res = torch.empty(shape, dtype=dtype, device=device)
+        self.allocated_bytes = self.allocated_bytes + res.element_size() * res.nelement()
+        return res
+
+    def release(self, tensor):
+        # only release buffers that nothing else refers to, the next acquire overwrites them.
+        size = tensor.element_size() * tensor.nelement()
+        if size > self.max_bytes:
+            self.evictions = self.evictions + 1
+            return
+        key = self.__internal__key(tensor.shape, tensor.dtype, tensor.device)
+        self.free.setdefault(key, []).append(tensor)
+        self.free.move_to_end(key)
+        self.held_bytes = self.held_bytes + size
+
+        while self.held_bytes > self.max_bytes:
+            key, pool = next(iter(self.free.items()))
+            res = pool.pop(0)
+            if len(pool) == 0:
+                del self.free[key]
+            self.held_bytes = self.held_bytes - res.element_size() * res.nelement()
+            self.evictions = self.evictions + 1
+
+    def clear(self):
+        self.free.clear()
+        self.held_bytes = 0
+
+    def reset_report(self):
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.reuses = 0
+        self.evictions = 0
+
+    def report(self):
+        # counts what went through this workspace only, count_allocations measures everything a call allocates.
+        return {
+            "allocations": self.allocations,
+            "allocated_bytes": self.allocated_bytes,
+            "reuses": self.reuses,
+            "evictions": self.evictions,
+            "held_bytes": self.held_bytes
+        }
+
+
+shared = Workspace()
+
+
+def count_allocations(function, repeat=100):
+    # every tensor the allocator hands out while function runs, workspace or not, as (count, bytes).
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profile:
+        for i in range(repeat):
+            function()
+    allocations = [e for e in profile.events() if e.self_cpu_memory_usage > 0]
+    return len(allocations), sum([e.self_cpu_memory_usage for e in allocations])
+
+
+if __name__ == '__main__':
+    print("assert workspace removes allocations from the hot path")
+
+    from conceptor import Cross_Correlational_Conceptor
+    from linear import Conceptor
+
+    dtype = torch.float
+    device = torch.device("cpu")
+
+    x = torch.rand(4, 5, 28, 28, device=device)
+    x_flat = torch.rand(20, 30, device=device)
+
+    for name, workspace in [("without reuse", Workspace(max_bytes=0)), ("with reuse", Workspace())]:
+        layer1 = Cross_Correlational_Conceptor(device, kernel_size=(3, 3), workspace=workspace)
+        layer2 = Conceptor(device, workspace=workspace)
+
+        layer1.learn(x, 3)
+        layer2.learn(x_flat, 1)
+        print(name, "learn, workspace:", workspace.report())
+
+        hidden = layer1 << x
+        workspace.reset_report()
+        # the only tensor left per call should be the returned code.
+        print(name, "100 inferences, all allocations (count, bytes):", count_allocations(lambda: layer1 << x), "output bytes:", hidden.element_size() * hidden.nelement())
+        print(name, "100 inferences, workspace:", workspace.report())
+
+        hidden = layer2 << x_flat
+        print(name, "100 linear inferences, all allocations (count, bytes):", count_allocations(lambda: layer2 << x_flat), "output bytes:", hidden.element_size() * hidden.nelement())